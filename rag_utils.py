@@ -0,0 +1,110 @@
+"""
+Retrieval and chat-history helpers shared by the EDU Bot assistants
+"""
+
+import os
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict
+import numpy as np
+
+def decode_embedding(encoded: str) -> np.ndarray:
+    """Decode a base64 embedding from the API into a float32 vector"""
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float32)
+
+def get_content_hash(text: str) -> str:
+    """Generate the embedding cache key for a document"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def load_embedding_cache(path: str) -> Dict[str, np.ndarray]:
+    """Load persisted passage embeddings keyed by content hash"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as data:
+            return dict(zip(data["keys"].tolist(), data["vecs"].astype(np.float32)))
+    except Exception as e:
+        print(f"Warning: could not read embedding cache {path}: {e}")
+        return {}
+
+def save_embedding_cache(path: str, cache: Dict[str, np.ndarray]):
+    """Persist passage embeddings as float16 to halve disk usage"""
+    if not cache:
+        return
+    try:
+        keys = list(cache)
+        vecs = np.stack([cache[key] for key in keys]).astype(np.float16)
+        np.savez_compressed(path, keys=np.array(keys), vecs=vecs)
+    except Exception as e:
+        print(f"Warning: could not write embedding cache {path}: {e}")
+
+def embed_in_chunks(texts: List[str], embed_chunk_fn: Callable[[List[str]], List[np.ndarray]],
+                    batch_size: int = 64, max_workers: int = 16) -> List[np.ndarray]:
+    """Embed many texts by sending chunks of batch_size to embed_chunk_fn concurrently"""
+    chunks = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    if not chunks:
+        return []
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        results = executor.map(embed_chunk_fn, chunks)
+        return [embedding for result in results for embedding in result]
+
+def embed_with_cache(texts: List[str], embed_batch_fn: Callable[[List[str]], List[np.ndarray]],
+                     path: str) -> tuple:
+    """Embed texts through the on-disk cache at path, returning (keys, cache).
+    
+    keys[i] is the content hash of texts[i]; a key is missing from cache when its embedding failed.
+    """
+    # Only embed documents that are not already in the on-disk cache
+    cache = load_embedding_cache(path)
+    keys = [get_content_hash(text) for text in texts]
+    # Deduplicate by hash so identical documents are embedded once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cache:
+            missing.setdefault(key, text)
+    if missing:
+        print(f"Embedding {len(missing)} new documents... (this may take a minute)")
+        embeddings = embed_batch_fn(list(missing.values()))
+        for key, embedding in zip(missing, embeddings):
+            if embedding is not None:
+                cache[key] = np.asarray(embedding, dtype=np.float32)
+        save_embedding_cache(path, {key: cache[key] for key in keys if key in cache})
+    return keys, cache
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+def trim_to_budget(messages: List[Dict], max_tokens: int = 2048) -> List[Dict]:
+    """Keep the most recent messages whose estimated tokens fit in max_tokens"""
+    total = 0
+    kept = 0
+    for message in reversed(messages):
+        total += estimate_tokens(message.get("content", ""))
+        if total > max_tokens:
+            break
+        kept += 1
+    trimmed = messages[len(messages) - kept:]
+    # Don't open the history with an answer whose question was dropped
+    if trimmed and trimmed[0].get("role") == "assistant":
+        trimmed = trimmed[1:]
+    return trimmed
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first, without a full sort"""
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, top_k)[:top_k]
+    return top[np.argsort(-scores[top])]
+
+def cut_at_score_gap(indices: np.ndarray, scores: np.ndarray, max_gap: float = 0.2, min_ratio: float = 0.5) -> tuple:
+    """Drop trailing matches that fall well behind the ones ranked above them
+    (scores[j] is the score of indices[j], best first)"""
+    kept = min(len(indices), 1)
+    while kept < len(indices):
+        if scores[kept - 1] - scores[kept] > max_gap or scores[kept] < min_ratio * scores[0]:
+            break
+        kept += 1
+    return indices[:kept], scores[:kept]
@@ -6,14 +6,32 @@ Uses NVIDIA NIM APIs with RAG, without heavy UI dependencies
 
 import os
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import soundfile as sf
 import numpy as np
+from rag_utils import (decode_embedding, embed_in_chunks, embed_with_cache,
+                       trim_to_budget, top_k_indices, cut_at_score_gap)
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+try:
+    import hnswlib
+    HNSWLIB_AVAILABLE = True
+except ImportError:
+    HNSWLIB_AVAILABLE = False
 
 # Load environment variables
 load_dotenv()
 
+# Corpus size at which retrieval switches from a dense scan to an HNSW index
+ANN_MIN_DOCUMENTS = 10000
+
 class NVIDIANIMClient:
     """Simple client for NVIDIA NIM APIs"""
     
@@ -24,49 +42,139 @@ class NVIDIANIMClient:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        # One persistent session so every call reuses the same keep-alive connection;
+        # the pool is sized for the concurrent embedding workers
+        retries = Retry(total=3, backoff_factor=0.2,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=frozenset(["POST"]))
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
+        self.session.headers.update(self.headers)
+        # Fixed request fields are serialized once; each call only splices in its
+        # variable fields (prefixes are the JSON objects minus the closing brace)
+        self._chat_prefix = orjson.dumps({"model": "nvidia/llama-3.1-nemotron-nano-8b-v1"})[:-1]
+        self._embedding_prefix = orjson.dumps({
+            "model": "nvidia/nv-embedqa-e5-v5",
+            "encoding_format": "base64"
+        })[:-1]
+    
+    def chat_body(self, messages, temperature, max_tokens, stream=False):
+        """Serialize a chat completion request from the cached prefix"""
+        body = (self._chat_prefix
+                + b',"messages":' + orjson.dumps(messages)
+                + b',"temperature":' + orjson.dumps(temperature)
+                + b',"max_tokens":' + orjson.dumps(max_tokens))
+        if stream:
+            body += b',"stream":true'
+        return body + b'}'
+    
+    def embedding_body(self, texts, input_type):
+        """Serialize an embedding request from the cached prefix"""
+        return (self._embedding_prefix
+                + b',"input":' + orjson.dumps(texts)
+                + b',"input_type":' + orjson.dumps(input_type) + b'}')
     
     def chat_completion(self, messages, temperature=0.5, max_tokens=1024):
         """Generate chat completion"""
         url = f"{self.base_url}/chat/completions"
-        payload = {
-            "model": "nvidia/llama-3.1-nemotron-nano-8b-v1",
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        body = self.chat_body(messages, temperature, max_tokens)
         
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, data=body)
             response.raise_for_status()
-            return response.json()['choices'][0]['message']['content']
+            return orjson.loads(response.content)['choices'][0]['message']['content']
         except Exception as e:
             return f"Error: {str(e)}"
     
+    def chat_completion_stream(self, messages, temperature=0.5, max_tokens=1024):
+        """Stream chat completion, yielding tokens as they arrive"""
+        url = f"{self.base_url}/chat/completions"
+        body = self.chat_body(messages, temperature, max_tokens, stream=True)
+        
+        try:
+            with self.session.post(url, data=body, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    choices = orjson.loads(data).get('choices')
+                    if choices:
+                        token = choices[0].get('delta', {}).get('content')
+                        if token:
+                            yield token
+        except Exception as e:
+            yield f"Error: {str(e)}"
+    
     def get_embedding(self, text, input_type="query"):
-        """Generate text embedding"""
+        """Generate text embedding as a float32 vector"""
         url = f"{self.base_url}/embeddings"
-        payload = {
-            "model": "nvidia/nv-embedqa-e5-v5",
-            "input": text,
-            "input_type": input_type,
-            "encoding_format": "float"
-        }
+        body = self.embedding_body(text, input_type)
         
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, data=body)
             response.raise_for_status()
-            return response.json()['data'][0]['embedding']
+            return decode_embedding(orjson.loads(response.content)['data'][0]['embedding'])
         except Exception as e:
             print(f"Embedding error: {str(e)}")
             return None
+    
+    def get_embeddings_chunk(self, texts, input_type="passage"):
+        """Generate embeddings for a list of texts in a single request"""
+        url = f"{self.base_url}/embeddings"
+        body = self.embedding_body(texts, input_type)
+        
+        try:
+            response = self.session.post(url, data=body)
+            response.raise_for_status()
+            data = sorted(orjson.loads(response.content)['data'], key=lambda d: d['index'])
+            return [decode_embedding(d['embedding']) for d in data]
+        except Exception as e:
+            print(f"Embedding error: {str(e)}")
+            return [None] * len(texts)
+    
+    def get_embeddings_batch(self, texts, input_type="passage", batch_size=64, max_workers=16):
+        """Generate embeddings for many texts, sending chunks concurrently"""
+        return embed_in_chunks(texts, lambda chunk: self.get_embeddings_chunk(chunk, input_type),
+                               batch_size, max_workers)
+
+def quantize(matrix):
+    """Quantize rows to int8 with a per-row scale (row ~= quantized * scale)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scale = np.abs(matrix).max(axis=1) / 127
+    scale[scale == 0] = 1.0
+    quantized = np.round(matrix / scale[:, None]).clip(-127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+if NUMBA_AVAILABLE:
+    @njit("int32[::1](int8[:, ::1], int8[::1])", parallel=True, cache=True)
+    def batch_dot_int8(matrix, vector):
+        """int8 matrix-vector product with integer accumulation, parallel over rows"""
+        out = np.empty(matrix.shape[0], np.int32)
+        for i in prange(matrix.shape[0]):
+            acc = 0
+            for d in range(matrix.shape[1]):
+                acc += np.int32(matrix[i, d]) * np.int32(vector[d])
+            out[i] = acc
+        return out
 
 class SimpleRAG:
     """Simple RAG implementation"""
     
-    def __init__(self, client, knowledge_file="data.json"):
+    def __init__(self, client, knowledge_file="data.json", cache_file="emb_cache.npz", use_int8=NUMBA_AVAILABLE):
         self.client = client
+        self.cache_file = cache_file
+        # Without numba, int8 scoring would upcast the whole matrix per query
+        self.use_int8 = use_int8 and NUMBA_AVAILABLE
         self.documents = []
-        self.embeddings = []
+        self.contents = []
+        self.titles = []
+        self.E = None
+        self.Eq = None
+        self.Escale = None
+        self.ann = None
         self.load_knowledge(knowledge_file)
     
     def load_knowledge(self, filename):
@@ -94,49 +202,77 @@ class SimpleRAG:
                 self.documents = data.get('documents', [])
         
         print(f"Loaded {len(self.documents)} documents")
-        print("Generating embeddings... (this may take a minute)")
         
-        for i, doc in enumerate(self.documents):
-            text = doc.get('content', '')
-            embedding = self.client.get_embedding(text, input_type="passage")
-            if embedding:
-                self.embeddings.append(embedding)
-            print(f"  {i+1}/{len(self.documents)} embeddings generated", end='\r')
+        texts = [doc.get('content', '') for doc in self.documents]
+        keys, cache = embed_with_cache(
+            texts, lambda batch: self.client.get_embeddings_batch(batch, input_type="passage"), self.cache_file
+        )
+        
+        # Drop documents whose embedding failed so documents and rows stay aligned
+        self.documents = [doc for doc, key in zip(self.documents, keys) if key in cache]
+        keys = [key for key in keys if key in cache]
+        self.contents = [doc.get('content', '') for doc in self.documents]
+        self.titles = [doc.get('title', 'Unknown') for doc in self.documents]
+        
+        # One contiguous float32 matrix of L2-normalized rows, so retrieval is a
+        # single matrix-vector product
+        if keys:
+            self.E = np.empty((len(keys), len(cache[keys[0]])), dtype=np.float32)
+            for i, key in enumerate(keys):
+                row = np.asarray(cache[key], dtype=np.float32)
+                self.E[i] = row / np.linalg.norm(row)
+            
+            # Dense scans grow linearly with the corpus; switch to an HNSW index for large ones
+            if HNSWLIB_AVAILABLE and len(keys) >= ANN_MIN_DOCUMENTS:
+                self.ann = hnswlib.Index(space="ip", dim=self.E.shape[1])
+                self.ann.init_index(max_elements=len(keys), ef_construction=200, M=16)
+                self.ann.add_items(self.E, np.arange(len(keys)))
+                self.ann.set_ef(50)
+            elif self.use_int8:
+                # The int8 copy replaces the float matrix, cutting resident memory 4x
+                self.Eq, self.Escale = quantize(self.E)
+                self.E = None
+        
+        print(f"✓ Knowledge base ready with {len(self.documents)} embeddings")
+    
+    def similarities(self, query_vector):
+        """Cosine similarity of a normalized query against every document"""
+        if self.Eq is None:
+            return self.E @ query_vector
         
-        print(f"\n✓ Knowledge base ready with {len(self.embeddings)} embeddings")
+        # int8 dot products with int32 accumulation, rescaled back to cosine; the query
+        # gets its own scale so its small components keep the full int8 range
+        query_q, query_scale = quantize(query_vector[None, :])
+        dots = batch_dot_int8(self.Eq, query_q[0])
+        return dots * (self.Escale * query_scale[0])
     
-    def cosine_similarity(self, vec1, vec2):
-        """Calculate cosine similarity"""
-        vec1 = np.array(vec1)
-        vec2 = np.array(vec2)
-        return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+    def search(self, query_vector, top_k):
+        """Best top_k document indices and their similarities, best first"""
+        if self.ann is not None:
+            labels, distances = self.ann.knn_query(query_vector.astype(np.float32), k=min(top_k, len(self.contents)))
+            return labels[0].astype(np.int64), 1.0 - distances[0]
+        
+        similarities = self.similarities(query_vector)
+        top_indices = top_k_indices(similarities, top_k)
+        return top_indices, similarities[top_indices]
     
     def retrieve(self, query, top_k=3):
-        """Retrieve relevant documents"""
-        if not self.embeddings:
-            return []
+        """Retrieve relevant documents as (context, [(title, score), ...])"""
+        if not self.contents:
+            return "", []
         
         query_embedding = self.client.get_embedding(query, input_type="query")
-        if not query_embedding:
-            return []
-        
-        similarities = []
-        for i, doc_embedding in enumerate(self.embeddings):
-            sim = self.cosine_similarity(query_embedding, doc_embedding)
-            similarities.append((i, sim))
-        
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        
-        results = []
-        for idx, score in similarities[:top_k]:
-            if score > 0.3:  # Threshold
-                results.append({
-                    'content': self.documents[idx].get('content', ''),
-                    'title': self.documents[idx].get('title', 'Unknown'),
-                    'score': float(score)
-                })
-        
-        return results
+        if query_embedding is None:
+            return "", []
+        
+        query_vector = query_embedding / np.linalg.norm(query_embedding)
+        top_indices, top_scores = cut_at_score_gap(*self.search(query_vector, top_k))
+        mask = top_scores > 0.3  # Threshold
+        relevant = top_indices[mask].tolist()
+        
+        context = "\n\n".join(self.contents[i] for i in relevant)
+        matches = [(self.titles[i], score) for i, score in zip(relevant, top_scores[mask].tolist())]
+        return context, matches
 
 def main():
     """Main function"""
@@ -172,17 +308,14 @@ def main():
         print("\n🔍 Searching knowledge base...")
         
         # Retrieve relevant documents
-        relevant_docs = rag.retrieve(user_input, top_k=3)
+        context, matches = rag.retrieve(user_input, top_k=3)
         
-        if relevant_docs:
-            print(f"   Found {len(relevant_docs)} relevant documents:")
-            for i, doc in enumerate(relevant_docs):
-                print(f"   {i+1}. {doc['title']} (relevance: {doc['score']:.2f})")
-            
-            context = "\n\n".join([doc['content'] for doc in relevant_docs])
+        if matches:
+            print(f"   Found {len(matches)} relevant documents:")
+            for i, (title, score) in enumerate(matches):
+                print(f"   {i+1}. {title} (relevance: {score:.2f})")
         else:
             print("   No relevant documents found")
-            context = ""
         
         # Prepare messages
         system_prompt = """You are EDU Bot, a helpful AI assistant for UMass Dartmouth students.
@@ -191,9 +324,8 @@ If the context doesn't contain relevant information, say so politely."""
         
         messages = [{"role": "system", "content": system_prompt}]
         
-        # Add conversation history (last 5 exchanges)
-        for msg in conversation_history[-10:]:
-            messages.append(msg)
+        # Add as much recent conversation history as fits the token budget
+        messages.extend(trim_to_budget(conversation_history))
         
         # Add current query with context
         if context:
@@ -205,10 +337,13 @@ If the context doesn't contain relevant information, say so politely."""
         
         print("\n💭 Generating response...")
         
-        # Generate response
-        response = client.chat_completion(messages)
-        
-        print(f"\n🤖 EDU Bot: {response}\n")
+        # Stream the response as it is generated
+        print("\n🤖 EDU Bot: ", end='', flush=True)
+        response = ""
+        for token in client.chat_completion_stream(messages):
+            print(token, end='', flush=True)
+            response += token
+        print("\n")
         
         # Update conversation history
         conversation_history.append({"role": "user", "content": user_input})
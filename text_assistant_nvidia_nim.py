@@ -7,11 +7,20 @@ Powered by NVIDIA NIM with RAG
 import os
 import json
 import hashlib
-from typing import List, Dict
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict, Iterator
 import numpy as np
 from dotenv import load_dotenv
 import gradio as gr
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rag_utils import (decode_embedding, embed_in_chunks, embed_with_cache,
+                       trim_to_budget, top_k_indices, cut_at_score_gap)
 
 # Load environment variables
 load_dotenv()
@@ -20,87 +29,175 @@ load_dotenv()
 NVIDIA_API_KEY = os.getenv('NVIDIA_API_KEY')
 LLM_NIM_ENDPOINT = os.getenv('LLM_NIM_ENDPOINT', 'https://integrate.api.nvidia.com/v1')
 EMBEDDING_NIM_ENDPOINT = os.getenv('EMBEDDING_NIM_ENDPOINT', 'https://integrate.api.nvidia.com/v1')
+EMBEDDING_CACHE_FILE = os.getenv('EMBEDDING_CACHE_FILE', 'emb_cache.npz')
+RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', 'resp_cache.sqlite')
+LLM_MODEL = "nvidia/llama-3.1-nemotron-nano-8b-v1"
+LLM_TEMPERATURE = 0.7
+HISTORY_TOKEN_BUDGET = 2048
 
 print("🤖 Initializing EDU Bot...")
 
-# Cache for responses
-response_cache = {}
+@dataclass
+class KnowledgeBase:
+    """Knowledge base documents and their L2-normalized embedding matrix"""
+    contents: List[str] = field(default_factory=list)
+    embeddings: np.ndarray = field(default_factory=lambda: np.empty((0, 0), dtype=np.float32))
+    
+    def __len__(self):
+        return len(self.contents)
+
+# Shared HTTP session so all NIM calls reuse keep-alive connections;
+# the pool is sized for the concurrent embedding workers
+nim_retries = Retry(total=3, backoff_factor=0.2,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset(["POST"]))
+nim_session = requests.Session()
+for prefix in ("https://", "http://"):
+    nim_session.mount(prefix, HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=nim_retries))
+nim_session.headers.update({
+    "Authorization": f"Bearer {NVIDIA_API_KEY}",
+    "Content-Type": "application/json"
+})
+
+# Cache for responses, persisted in SQLite so it survives restarts
+response_cache_db = sqlite3.connect(RESPONSE_CACHE_FILE, isolation_level=None, check_same_thread=False)
+response_cache_db.execute("PRAGMA journal_mode=WAL")
+response_cache_db.execute("PRAGMA synchronous=NORMAL")
+response_cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+response_cache_lock = threading.Lock()
+
+# LRU cache for query embeddings, keyed by content hash
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+query_embedding_cache = OrderedDict()
+query_embedding_lock = threading.Lock()
 
 def get_cache_key(text):
     """Generate cache key for responses"""
-    return hashlib.md5(text.encode()).hexdigest()
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def get_cached_response(cache_key):
+    """Look up a cached LLM response"""
+    with response_cache_lock:
+        row = response_cache_db.execute(
+            "SELECT response FROM responses WHERE key = ?", (cache_key,)
+        ).fetchone()
+    return row[0] if row else None
 
-def get_embedding(text: str, input_type: str = "query") -> List[float]:
-    """Get embeddings from NVIDIA NIM Embedding API"""
+def cache_response(cache_key, response):
+    """Store an LLM response in the persistent cache"""
+    with response_cache_lock:
+        response_cache_db.execute(
+            "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (cache_key, response)
+        )
+
+def get_embedding(text: str, input_type: str = "query") -> np.ndarray:
+    """Get embeddings from NVIDIA NIM Embedding API, reusing cached results"""
+    key = hashlib.blake2b(f"{input_type}:{text}".encode(), digest_size=16).digest()
+    with query_embedding_lock:
+        cached = query_embedding_cache.get(key)
+        if cached is not None:
+            query_embedding_cache.move_to_end(key)
+            return cached
+    
     try:
-        headers = {
-            "Authorization": f"Bearer {NVIDIA_API_KEY}",
-            "Content-Type": "application/json"
-        }
         payload = {
             "input": text,
             "model": "nvidia/nv-embedqa-e5-v5",
             "input_type": input_type,
-            "encoding_format": "float"
+            "encoding_format": "base64"
         }
-        response = requests.post(
+        response = nim_session.post(
             f"{EMBEDDING_NIM_ENDPOINT}/embeddings",
-            headers=headers,
             json=payload,
             timeout=30
         )
         response.raise_for_status()
-        return response.json()["data"][0]["embedding"]
+        embedding = decode_embedding(orjson.loads(response.content)["data"][0]["embedding"])
     except Exception as e:
         print(f"❌ Error getting embedding: {e}")
         return None
+    
+    with query_embedding_lock:
+        query_embedding_cache[key] = embedding
+        if len(query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            query_embedding_cache.popitem(last=False)
+    return embedding
 
-def retrieve_relevant_context(query: str, knowledge_base: List[Dict], top_k: int = 3) -> tuple:
+def get_embeddings_chunk(texts: List[str], input_type: str = "passage") -> List[np.ndarray]:
+    """Get embeddings for a list of texts in a single request"""
+    try:
+        payload = {
+            "input": texts,
+            "model": "nvidia/nv-embedqa-e5-v5",
+            "input_type": input_type,
+            "encoding_format": "base64"
+        }
+        response = nim_session.post(
+            f"{EMBEDDING_NIM_ENDPOINT}/embeddings",
+            json=payload,
+            timeout=60
+        )
+        response.raise_for_status()
+        data = sorted(orjson.loads(response.content)["data"], key=lambda d: d["index"])
+        return [decode_embedding(d["embedding"]) for d in data]
+    except Exception as e:
+        print(f"❌ Error getting embeddings: {e}")
+        return [None] * len(texts)
+
+def get_embeddings_batch(texts: List[str], input_type: str = "passage",
+                         batch_size: int = 64, max_workers: int = 16) -> List[np.ndarray]:
+    """Get embeddings for many texts, sending chunks of batch_size concurrently"""
+    return embed_in_chunks(texts, lambda chunk: get_embeddings_chunk(chunk, input_type),
+                           batch_size, max_workers)
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize each row so dot products equal cosine similarity"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def retrieve_relevant_context(query: str, knowledge_base: KnowledgeBase, top_k: int = 3) -> tuple:
     """Retrieve relevant context using embedding similarity"""
     if not knowledge_base:
         return "", []
     
     query_embedding = get_embedding(query, input_type="query")
-    if not query_embedding:
+    if query_embedding is None:
         return "", []
     
-    # Calculate cosine similarity
-    similarities = []
-    for item in knowledge_base:
-        if "embedding" in item:
-            similarity = np.dot(query_embedding, item["embedding"]) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(item["embedding"])
-            )
-            similarities.append((similarity, item["content"]))
+    # Cosine similarity against every document in one matrix-vector product
+    # (not normalized in place: the embedding is shared with the cache)
+    query_vector = query_embedding / np.linalg.norm(query_embedding)
+    similarities = knowledge_base.embeddings @ query_vector
     
     # Sort by similarity and get top_k
-    similarities.sort(reverse=True, key=lambda x: x[0])
-    top_contexts = similarities[:top_k]
+    top_indices = top_k_indices(similarities, top_k)
+    # Skip weaker matches when the best ones clearly dominate, to keep prompts short
+    top_indices, top_scores = cut_at_score_gap(top_indices, similarities[top_indices])
     
     # Filter by threshold
-    relevant_contexts = [(score, content) for score, content in top_contexts if score > 0.3]
+    mask = top_scores > 0.3
+    relevant = top_indices[mask].tolist()
     
-    if not relevant_contexts:
+    if not relevant:
         return "", []
     
     # Format context
-    context_text = "\n\n".join([content for _, content in relevant_contexts])
-    context_info = [{"score": float(score), "content": content} for score, content in relevant_contexts]
+    contents = knowledge_base.contents
+    context_text = "\n\n".join(contents[i] for i in relevant)
+    context_info = [{"score": score, "content": contents[i]} for i, score in zip(relevant, top_scores[mask].tolist())]
     
     return context_text, context_info
 
-def generate_response(query: str, context: str = "", conversation_history: List[Dict] = None) -> str:
-    """Generate response using NVIDIA NIM LLM"""
+def generate_response(query: str, context: str = "", conversation_history: List[Dict] = None) -> Iterator[str]:
+    """Stream response from NVIDIA NIM LLM, yielding the text generated so far"""
     try:
         # Check cache
-        cache_key = get_cache_key(f"{query}{context}")
-        if cache_key in response_cache:
-            return response_cache[cache_key]
-        
-        headers = {
-            "Authorization": f"Bearer {NVIDIA_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        cache_key = get_cache_key(f"{LLM_MODEL}|{LLM_TEMPERATURE}|{query}{context}")
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            yield cached
+            return
         
         # Build messages
         system_prompt = """You are EDU Bot, a helpful AI assistant for UMass Dartmouth students. 
@@ -109,9 +206,9 @@ If the context doesn't contain relevant information, say so politely and provide
         
         messages = [{"role": "system", "content": system_prompt}]
         
-        # Add conversation history (last 10 exchanges)
+        # Add as much recent conversation history as fits the token budget
         if conversation_history:
-            messages.extend(conversation_history[-20:])
+            messages.extend(trim_to_budget(conversation_history, HISTORY_TOKEN_BUDGET))
         
         # Add current query with context
         if context:
@@ -123,63 +220,85 @@ If the context doesn't contain relevant information, say so politely and provide
         
         # Call NVIDIA NIM API
         payload = {
-            "model": "nvidia/llama-3.1-nemotron-nano-8b-v1",
+            "model": LLM_MODEL,
             "messages": messages,
-            "temperature": 0.7,
+            "temperature": LLM_TEMPERATURE,
             "max_tokens": 1024,
-            "top_p": 0.9
+            "top_p": 0.9,
+            "stream": True
         }
         
-        response = requests.post(
+        # Read Server-Sent Events so tokens reach the UI as they are generated
+        result = ""
+        with nim_session.post(
             f"{LLM_NIM_ENDPOINT}/chat/completions",
-            headers=headers,
             json=payload,
-            timeout=60
-        )
-        response.raise_for_status()
-        
-        result = response.json()["choices"][0]["message"]["content"]
+            timeout=60,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices")
+                if not choices:
+                    continue
+                token = choices[0].get("delta", {}).get("content")
+                if token:
+                    result += token
+                    yield result
         
         # Cache the response
-        response_cache[cache_key] = result
-        
-        return result
+        if result:
+            cache_response(cache_key, result)
         
     except Exception as e:
         error_msg = f"Error generating response: {str(e)}"
         print(f"❌ {error_msg}")
-        return f"I apologize, but I encountered an error: {str(e)}\n\nPlease try again or rephrase your question."
+        yield f"I apologize, but I encountered an error: {str(e)}\n\nPlease try again or rephrase your question."
 
-def load_knowledge_base():
+def load_knowledge_base() -> KnowledgeBase:
     """Load knowledge base from data.json"""
-    knowledge_base = []
-    
     try:
         with open('data.json', 'r') as f:
             data = json.load(f)
         
         print(f"📚 Loading knowledge base...")
-        for i, item in enumerate(data):
+        contents = []
+        for item in data:
             conv = item.get("conversation", [])
             if len(conv) >= 2:
                 question = conv[0].get("content", "")
                 answer = conv[1].get("content", "")
-                content = f"Q: {question}\nA: {answer}"
-                
-                print(f"  Processing {i+1}/{len(data)}...", end='\r')
-                embedding = get_embedding(content, input_type="passage")
-                if embedding:
-                    knowledge_base.append({
-                        "content": content,
-                        "embedding": embedding
-                    })
+                contents.append(f"Q: {question}\nA: {answer}")
+        
+        keys, cache = embed_with_cache(
+            contents, lambda batch: get_embeddings_batch(batch, input_type="passage"), EMBEDDING_CACHE_FILE
+        )
         
-        print(f"\n✅ Loaded {len(knowledge_base)} items into knowledge base")
+        kb_contents = []
+        kb_embeddings = []
+        for content, key in zip(contents, keys):
+            embedding = cache.get(key)
+            if embedding is not None:
+                kb_contents.append(content)
+                kb_embeddings.append(embedding)
+        
+        knowledge_base = KnowledgeBase(contents=kb_contents)
+        if kb_embeddings:
+            knowledge_base.embeddings = np.ascontiguousarray(
+                normalize_rows(np.vstack(kb_embeddings).astype(np.float32))
+            )
+        
+        print(f"✅ Loaded {len(knowledge_base)} items into knowledge base")
         return knowledge_base
         
     except Exception as e:
         print(f"❌ Error loading knowledge base: {e}")
-        return []
+        return KnowledgeBase()
 
 # Load knowledge base at startup
 print("📚 Loading knowledge base...")
@@ -187,9 +306,10 @@ initial_knowledge_base = load_knowledge_base()
 print("✅ Ready!")
 
 def chat_response(message, history, use_rag):
-    """Process chat message and return response"""
+    """Process chat message and stream the response"""
     if not message or not message.strip():
-        return "Please enter a question."
+        yield "Please enter a question."
+        return
     
     # Convert Gradio history format to our format
     conversation_history = []
@@ -212,7 +332,9 @@ def chat_response(message, history, use_rag):
                 print(f"  {i+1}. Score: {ctx['score']:.3f}")
     
     # Generate response
-    response = generate_response(message, context, conversation_history)
+    response = ""
+    for response in generate_response(message, context, conversation_history):
+        yield response
     
     # Add context information to response if available
     if context_info:
@@ -220,9 +342,7 @@ def chat_response(message, history, use_rag):
         for i, ctx in enumerate(context_info):
             snippet = ctx['content'][:200] + "..." if len(ctx['content']) > 200 else ctx['content']
             context_display += f"\n{i+1}. (Relevance: {ctx['score']:.2f})\n{snippet}\n"
-        response += context_display
-    
-    return response
+        yield response + context_display
 
 # Create Gradio interface
 with gr.Blocks(title="EDU Bot - UMass Dartmouth AI Assistant", theme=gr.themes.Soft()) as demo:
@@ -280,9 +400,11 @@ with gr.Blocks(title="EDU Bot - UMass Dartmouth AI Assistant", theme=gr.themes.S
     
     # Event handlers
     def respond(message, chat_history, use_rag):
-        bot_message = chat_response(message, chat_history, use_rag)
-        chat_history.append((message, bot_message))
-        return "", chat_history
+        stream = chat_response(message, list(chat_history), use_rag)
+        chat_history.append((message, ""))
+        for bot_message in stream:
+            chat_history[-1] = (message, bot_message)
+            yield "", chat_history
     
     msg.submit(respond, [msg, chatbot, use_rag], [msg, chatbot])
     submit.click(respond, [msg, chatbot, use_rag], [msg, chatbot])
@@ -292,4 +414,4 @@ if __name__ == "__main__":
     print("\n" + "="*60)
     print("🚀 Starting EDU Bot on http://localhost:7860")
     print("="*60 + "\n")
-    demo.launch(server_name="0.0.0.0", server_port=7860)
+    demo.queue().launch(server_name="0.0.0.0", server_port=7860)
@@ -1,23 +1,55 @@
 import os
+import re
 import time
 import tempfile
 import threading
-import hashlib
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import List, Dict
 import numpy as np
-import soundfile as sf
+import xxhash
+from cachetools import LRUCache
 from dotenv import load_dotenv
 import gradio as gr
 import torch
-from transformers import pipeline
+from transformers import pipeline, AutoModelForSpeechSeq2Seq, AutoProcessor
+from transformers.utils import is_flash_attn_2_available
+import torchaudio
+try:
+    from faster_whisper import WhisperModel
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    FASTER_WHISPER_AVAILABLE = False
 try:
     from kokoro import KPipeline
     KOKORO_AVAILABLE = True
 except ImportError:
     KOKORO_AVAILABLE = False
     print("⚠️  Kokoro TTS not available - TTS will be disabled")
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 
 load_dotenv()
@@ -28,14 +60,78 @@ NEMOTRON_NIM_ENDPOINT = os.getenv("NEMOTRON_NIM_ENDPOINT", "http://localhost:800
 EMBEDDING_NIM_ENDPOINT = os.getenv("EMBEDDING_NIM_ENDPOINT", "http://localhost:8001/v1")
 NVIDIA_API_KEY = os.getenv("NVIDIA_API_KEY", "")
 
-print("Initializing Whisper pipeline...")
-whisper_pipe = pipeline(
-    "automatic-speech-recognition",
-    model="openai/whisper-large-v3-turbo",
-    torch_dtype=torch.float16,
-    device=device
-)
-print("Whisper pipeline initialized!")
+# Shared HTTP session so NIM calls reuse keep-alive connections instead of
+# paying a TCP/TLS handshake per request
+nim_retries = Retry(total=2, backoff_factor=0.1,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset(["POST"]))
+nim_session = requests.Session()
+for prefix in ("https://", "http://"):
+    nim_session.mount(prefix, HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=nim_retries))
+nim_session.headers.update({
+    "Authorization": f"Bearer {NVIDIA_API_KEY}",
+    "Content-Type": "application/json",
+    "Connection": "keep-alive"
+})
+
+# Knowledge base size at which FAISS switches from exact to HNSW (approximate) search
+FAISS_HNSW_MIN_DOCUMENTS = 10000
+# ...and from HNSW to an IVF-PQ index storing FAISS_PQ_BYTES per vector
+FAISS_PQ_MIN_DOCUMENTS = 100000
+FAISS_PQ_BYTES = 32
+
+WHISPER_MODEL_ID = "openai/whisper-large-v3-turbo"
+WHISPER_SAMPLE_RATE = 16000
+# torch.compile is opt-in: it needs a static KV cache and is not compatible with
+# FlashAttention-2 or chunked long-form decoding
+WHISPER_TORCH_COMPILE = os.getenv("WHISPER_TORCH_COMPILE", "0") == "1"
+# Opt-in torch.compile for Kokoro (default mode: its output shapes depend on the input,
+# so CUDA-graph modes would record a new graph for almost every sentence)
+KOKORO_TORCH_COMPILE = os.getenv("KOKORO_TORCH_COMPILE", "0") == "1"
+
+if FASTER_WHISPER_AVAILABLE:
+    # CTranslate2 backend: int8 weights with fp16 activations on the GPU
+    print("Initializing faster-whisper...")
+    whisper_model = WhisperModel(
+        "large-v3-turbo",
+        device=device,
+        compute_type="int8_float16" if device == "cuda" else "int8"
+    )
+    whisper_pipe = None
+    print("faster-whisper initialized!")
+else:
+    print("Initializing Whisper pipeline...")
+    whisper_dtype = torch.float16 if device == "cuda" else torch.float32
+    if device == "cuda" and is_flash_attn_2_available() and not WHISPER_TORCH_COMPILE:
+        whisper_attn = "flash_attention_2"
+    else:
+        whisper_attn = "sdpa"
+    whisper_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+        WHISPER_MODEL_ID,
+        torch_dtype=whisper_dtype,
+        low_cpu_mem_usage=True,
+        attn_implementation=whisper_attn
+    ).to(device)
+    whisper_processor = AutoProcessor.from_pretrained(WHISPER_MODEL_ID)
+
+    if WHISPER_TORCH_COMPILE and device == "cuda":
+        whisper_model.generation_config.cache_implementation = "static"
+        whisper_model.forward = torch.compile(whisper_model.forward, mode="reduce-overhead", fullgraph=True)
+        whisper_chunking = {}
+    else:
+        # Long recordings are split into 30 s windows and batched through the encoder
+        whisper_chunking = {"chunk_length_s": 30, "batch_size": 8}
+
+    whisper_pipe = pipeline(
+        "automatic-speech-recognition",
+        model=whisper_model,
+        tokenizer=whisper_processor.tokenizer,
+        feature_extractor=whisper_processor.feature_extractor,
+        torch_dtype=whisper_dtype,
+        device=device,
+        **whisper_chunking
+    )
+    print(f"Whisper pipeline initialized! (attention: {whisper_attn})")
 
 if KOKORO_AVAILABLE:
     os.environ['ESPEAK_DATA_PATH'] = "/usr/lib/x86_64-linux-gnu/espeak-ng-data"
@@ -45,146 +141,375 @@ else:
     kokoro_pipeline = None
     print("Running without TTS - audio output disabled")
 
-response_cache = {}
-tts_cache = {}
+# In-process embeddings on the local GPU skip the embedding NIM round-trip; set
+# EMBEDDING_BACKEND=nim to keep using the microservice
+LOCAL_EMBEDDING_MODEL = "intfloat/e5-large-v2"
+# E5 models expect these prefixes on queries and passages
+E5_PREFIXES = {"query": "query: ", "passage": "passage: "}
+if SENTENCE_TRANSFORMERS_AVAILABLE and device == "cuda" and os.getenv("EMBEDDING_BACKEND", "local") == "local":
+    embedder = SentenceTransformer(LOCAL_EMBEDDING_MODEL, device=device)
+    embedder.half()
+    print(f"Local embedder initialized! ({LOCAL_EMBEDDING_MODEL})")
+else:
+    embedder = None
+
+WELCOME_MESSAGE = "Welcome to EDU Bot, your UMass Dartmouth assistant—how can I help you today?"
+CONNECTION_ERROR_MESSAGE = "I'm having trouble connecting right now. Please try again."
+# Fixed replies synthesized in the background at startup so they never wait on TTS
+TTS_PRECOMPUTED_PHRASES = [WELCOME_MESSAGE, CONNECTION_ERROR_MESSAGE]
+
+TTS_SAMPLE_RATE = 24000
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "edubot-tts"))
+TTS_CACHE_SIZE_LIMIT = 2 * 1024 ** 3
+# Without diskcache, clips are held in memory up to this many bytes of audio
+TTS_MEMORY_CACHE_LIMIT = 512 * 1024 ** 2
+
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_THRESHOLD = 0.95
+if DISKCACHE_AVAILABLE:
+    # Synthesized audio survives restarts; least-recently-used clips are evicted past the size limit
+    tts_cache = diskcache.Cache(TTS_CACHE_DIR, size_limit=TTS_CACHE_SIZE_LIMIT,
+                                eviction_policy="least-recently-used")
+else:
+    tts_cache = LRUCache(maxsize=TTS_MEMORY_CACHE_LIMIT, getsizeof=lambda audio: audio.nbytes)
 cache_lock = threading.Lock()
 
+# Consumes the streamed LLM reply alongside the request thread, which plays the audio
+turn_executor = ThreadPoolExecutor(max_workers=4)
+# Kokoro runs on a single worker so sentences are synthesized in order, one at a time
+tts_executor = ThreadPoolExecutor(max_workers=1)
+# A sentence ends at ., ! or ? followed by whitespace
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
 @dataclass
 class AppState:
     conversation_history: list = field(default_factory=list)
-    knowledge_base: list = field(default_factory=list)
+    kb_contents: list = field(default_factory=list)
+    kb_matrix: np.ndarray = None
     is_first_interaction: bool = True
 
+class SemanticResponseCache:
+    """LRU cache of assistant replies, matched by cosine similarity of query embeddings"""
+    
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, threshold: float = RESPONSE_CACHE_THRESHOLD):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.matrix = None
+        self.answers = []
+        self.last_used = np.zeros(max_size, dtype=np.int64)
+        self.clock = 0
+        self.lock = threading.Lock()
+    
+    def get(self, query_vector: np.ndarray):
+        with self.lock:
+            if not self.answers:
+                return None
+            scores = self.matrix[:len(self.answers)] @ query_vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self.clock += 1
+            self.last_used[best] = self.clock
+            return self.answers[best]
+    
+    def put(self, query_vector: np.ndarray, answer: str):
+        with self.lock:
+            if self.matrix is None:
+                self.matrix = np.empty((self.max_size, len(query_vector)), dtype=np.float32)
+            if len(self.answers) < self.max_size:
+                slot = len(self.answers)
+                self.answers.append(answer)
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.answers[slot] = answer
+            self.matrix[slot] = query_vector
+            self.clock += 1
+            self.last_used[slot] = self.clock
+
+response_cache = SemanticResponseCache()
+
 def get_cache_key(text):
-    return hashlib.md5(text.encode()).hexdigest()
+    return xxhash.xxh3_64_hexdigest(text.encode())
 
-def get_embedding(text: str, input_type: str = "query") -> List[float]:
-    """Get embeddings from NVIDIA NIM Embedding microservice"""
+def get_embedding(text: str, input_type: str = "query") -> np.ndarray:
+    """Get embeddings from the local embedder or the NVIDIA NIM Embedding microservice"""
     try:
-        headers = {
-            "Authorization": f"Bearer {NVIDIA_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        if embedder is not None:
+            # encode() returns the fp16 model's dtype, so cast to match the NIM path
+            return embedder.encode(E5_PREFIXES[input_type] + text, normalize_embeddings=True,
+                                   convert_to_numpy=True).astype(np.float32)
+        
         payload = {
             "input": text,
             "model": "nvidia/nv-embedqa-e5-v5",
             "input_type": input_type,
             "encoding_format": "float"
         }
-        response = requests.post(
+        response = nim_session.post(
             f"{EMBEDDING_NIM_ENDPOINT}/embeddings",
-            headers=headers,
             json=payload,
             timeout=30
         )
         response.raise_for_status()
-        return response.json()["data"][0]["embedding"]
+        return np.asarray(response.json()["data"][0]["embedding"], dtype=np.float32)
     except Exception as e:
         print(f"Error getting embedding: {e}")
         return None
 
-def retrieve_relevant_context(query: str, knowledge_base: List[Dict], top_k: int = 3) -> str:
-    """Retrieve relevant context using embedding similarity"""
-    if not knowledge_base:
-        return ""
+def get_embeddings_batch(texts: List[str], input_type: str = "passage", batch_size: int = 64) -> List[np.ndarray]:
+    """Get embeddings for many texts, sending batch_size inputs per request"""
+    if embedder is not None:
+        try:
+            return list(embedder.encode([E5_PREFIXES[input_type] + text for text in texts],
+                                        batch_size=batch_size, normalize_embeddings=True,
+                                        convert_to_numpy=True).astype(np.float32))
+        except Exception as e:
+            print(f"Error getting embeddings: {e}")
+            return [None] * len(texts)
+    
+    embeddings = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        try:
+            payload = {
+                "input": batch,
+                "model": "nvidia/nv-embedqa-e5-v5",
+                "input_type": input_type,
+                "encoding_format": "float"
+            }
+            response = nim_session.post(
+                f"{EMBEDDING_NIM_ENDPOINT}/embeddings",
+                json=payload,
+                timeout=60
+            )
+            response.raise_for_status()
+            # Results are matched back to inputs by index
+            data = sorted(response.json()["data"], key=lambda d: d["index"])
+            embeddings.extend(np.asarray(d["embedding"], dtype=np.float32) for d in data)
+        except Exception as e:
+            print(f"Error getting embeddings: {e}")
+            embeddings.extend([None] * len(batch))
+    return embeddings
+
+def build_kb_index(kb_matrix: np.ndarray):
+    """Build a FAISS inner-product index over the normalized KB matrix, if FAISS is installed"""
+    global faiss_gpu_resources
+    if not FAISS_AVAILABLE or kb_matrix is None:
+        return None
     
+    vectors = np.ascontiguousarray(kb_matrix, dtype=np.float32)
+    dim = kb_matrix.shape[1]
+    if len(kb_matrix) >= FAISS_PQ_MIN_DOCUMENTS:
+        # Product quantization packs each vector into FAISS_PQ_BYTES bytes
+        quantizer = faiss.IndexFlatIP(dim)
+        nlist = int(4 * np.sqrt(len(kb_matrix)))
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, FAISS_PQ_BYTES, 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = 16
+    elif len(kb_matrix) >= FAISS_HNSW_MIN_DOCUMENTS:
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    index.add(vectors)
+    
+    # Exact search moves to the GPU when this FAISS build supports it
+    if device == "cuda" and isinstance(index, faiss.IndexFlatIP) and hasattr(faiss, "StandardGpuResources"):
+        faiss_gpu_resources = faiss.StandardGpuResources()
+        index = faiss.index_cpu_to_gpu(faiss_gpu_resources, 0, index)
+    return index
+
+def get_query_vector(query: str) -> np.ndarray:
+    """Embed a user query as an L2-normalized float32 vector"""
     query_embedding = get_embedding(query)
-    if not query_embedding:
+    if query_embedding is None:
+        return None
+    query_vector = np.asarray(query_embedding, dtype=np.float32)
+    return query_vector / np.linalg.norm(query_vector)
+
+def quantize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Symmetric per-row int8 quantization (cosine ranking is invariant to the per-row scale)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scale = 127.0 / np.maximum(np.abs(matrix).max(axis=1, keepdims=True), 1e-12)
+    return np.round(matrix * scale).astype(np.int8)
+
+def build_kb_matrix_i8(kb_matrix: np.ndarray) -> np.ndarray:
+    """int8 copy of the KB matrix for SimSIMD's integer dot-product kernels, if SimSIMD is installed"""
+    if not SIMSIMD_AVAILABLE or kb_matrix is None:
+        return None
+    return quantize_rows(kb_matrix)
+
+def retrieve_relevant_context(query_vector: np.ndarray, kb_contents: List[str], kb_matrix: np.ndarray,
+                              top_k: int = 3, kb_index=None, kb_matrix_i8: np.ndarray = None) -> str:
+    """Retrieve relevant context using embedding similarity"""
+    if kb_matrix is None or query_vector is None:
         return ""
     
-    # Calculate cosine similarity
-    similarities = []
-    for item in knowledge_base:
-        if "embedding" in item:
-            similarity = np.dot(query_embedding, item["embedding"]) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(item["embedding"])
-            )
-            similarities.append((similarity, item["content"]))
+    if kb_index is not None:
+        _, ids = kb_index.search(query_vector.reshape(1, -1), min(top_k, len(kb_contents)))
+        return "\n\n".join(kb_contents[i] for i in ids[0] if i >= 0)
+    
+    if kb_matrix_i8 is not None:
+        # int8 cosine distance on SIMD integer dot-product units (AVX-512 VNNI / NEON)
+        distances = simsimd.cdist(quantize_rows(query_vector[None, :]), kb_matrix_i8, metric="cosine")
+        scores = 1.0 - np.asarray(distances, dtype=np.float32)[0]
+    else:
+        # Cosine similarity against every document in one matrix-vector product
+        scores = kb_matrix @ query_vector
     
-    # Sort by similarity and get top_k
-    similarities.sort(reverse=True, key=lambda x: x[0])
-    relevant_contexts = [content for _, content in similarities[:top_k]]
+    # Select top_k without sorting the whole corpus
+    if top_k < len(scores):
+        top = np.argpartition(-scores, top_k)[:top_k]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.argsort(-scores[top])]
     
-    return "\n\n".join(relevant_contexts)
+    return "\n\n".join(kb_contents[i] for i in top)
 
-def call_nemotron_nim(messages: List[Dict], context: str = "") -> str:
-    """Call llama-3.1-nemotron-nano-8B-v1 via NVIDIA NIM"""
-    try:
-        headers = {
-            "Authorization": f"Bearer {NVIDIA_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Add context to system message if available
-        system_message = {
-            "role": "system",
-            "content": f"""You are EDUBOT, an intelligent voice assistant for UMass Dartmouth students. 
+# Sent byte-for-byte identical every turn so servers with prefix caching enabled
+# (e.g. --enable-prefix-caching) reuse its KV cache instead of recomputing it
+SYSTEM_PROMPT = """You are EDUBOT, an intelligent voice assistant for UMass Dartmouth students. 
 You provide helpful, accurate, and friendly responses about university topics.
 
-{f'Relevant Context: {context}' if context else ''}
-
 Keep responses conversational and concise (2-3 sentences). Do not use line breaks, bullets, or colons."""
-        }
-        
-        full_messages = [system_message] + messages
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+def stream_nemotron_nim(messages: List[Dict], context: str = "", completed: threading.Event = None):
+    """Stream llama-3.1-nemotron-nano-8B-v1 tokens from NVIDIA NIM as they are generated.
+    
+    completed, if given, is set only when the server ends the stream with [DONE].
+    """
+    streamed = False
+    try:
+        # Retrieved context goes in its own message just before the latest user turn,
+        # keeping the system prompt and earlier history a stable cacheable prefix
+        full_messages = [SYSTEM_MESSAGE] + messages
+        if context:
+            full_messages.insert(len(full_messages) - 1, {
+                "role": "user",
+                "content": f"Relevant Context: {context}"
+            })
         
         payload = {
             "model": "meta/llama-3.1-nemotron-70b-instruct",  # or your deployed model
             "messages": full_messages,
             "temperature": 0.6,
             "max_tokens": 400,
-            "top_p": 0.9
+            "top_p": 0.9,
+            "stream": True
         }
         
-        response = requests.post(
+        with nim_session.post(
             f"{NEMOTRON_NIM_ENDPOINT}/chat/completions",
-            headers=headers,
             json=payload,
-            timeout=60
-        )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+            timeout=60,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    if completed is not None:
+                        completed.set()
+                    break
+                choices = json.loads(data).get("choices")
+                if choices:
+                    token = choices[0].get("delta", {}).get("content")
+                    if token:
+                        streamed = True
+                        yield token
     except Exception as e:
         print(f"Error calling Nemotron NIM: {e}")
-        return f"I'm having trouble connecting right now. Please try again."
+        if not streamed:
+            yield CONNECTION_ERROR_MESSAGE
 
-def load_knowledge_base(json_path: str = "data.json") -> List[Dict]:
-    """Load and embed knowledge base"""
+def speak_token_stream(tokens, clips: queue.Queue) -> str:
+    """Collect streamed tokens, queueing TTS for each complete sentence as soon as it arrives.
+    
+    Each sentence's TTS future is put on clips in order, followed by None once the stream ends.
+    """
+    reply, pending = [], ""
+    try:
+        for token in tokens:
+            reply.append(token)
+            pending += token
+            sentences = SENTENCE_BOUNDARY.split(pending)
+            for sentence in sentences[:-1]:
+                clips.put(tts_executor.submit(generate_tts_audio_optimized, sentence.strip()))
+            pending = sentences[-1]
+        if pending.strip():
+            clips.put(tts_executor.submit(generate_tts_audio_optimized, pending.strip()))
+    finally:
+        clips.put(None)
+    return "".join(reply).strip()
+
+def load_knowledge_base(json_path: str = "data.json") -> tuple:
+    """Load and embed knowledge base as parallel contents and an L2-normalized float32 matrix"""
     try:
         with open(json_path, 'r') as f:
             data = json.load(f)
         
-        knowledge_base = []
+        contents = []
         for item in data:
             conv = item.get("conversation", [])
             if len(conv) >= 2:
                 question = conv[0].get("content", "")
                 answer = conv[1].get("content", "")
-                content = f"Q: {question}\nA: {answer}"
-                
-                embedding = get_embedding(content, input_type="passage")
-                if embedding:
-                    knowledge_base.append({
-                        "content": content,
-                        "embedding": embedding
-                    })
+                contents.append(f"Q: {question}\nA: {answer}")
+        
+        # Row i of kb_matrix always embeds kb_contents[i]; texts that failed to embed are dropped from both
+        embeddings = get_embeddings_batch(contents, input_type="passage")
+        kept = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        if not kept:
+            return [], None
+        kb_contents = [contents[i] for i in kept]
         
-        print(f"Loaded {len(knowledge_base)} items into knowledge base")
-        return knowledge_base
+        # Kept in float32 so scoring is a single GEMV with no per-query conversion copy
+        kb_matrix = np.asarray([embeddings[i] for i in kept], dtype=np.float32)
+        kb_matrix /= np.linalg.norm(kb_matrix, axis=1, keepdims=True)
+        
+        print(f"Loaded {len(kb_contents)} items into knowledge base")
+        return kb_contents, kb_matrix
     except Exception as e:
         print(f"Error loading knowledge base: {e}")
-        return []
+        return [], None
+
+def prepare_whisper_audio(audio_data, sample_rate):
+    """Convert a Gradio microphone buffer to mono float32 at Whisper's 16 kHz"""
+    audio = np.asarray(audio_data)
+    if np.issubdtype(audio.dtype, np.integer):
+        audio = audio.astype(np.float32) / np.iinfo(audio.dtype).max
+    else:
+        audio = audio.astype(np.float32, copy=False)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sample_rate != WHISPER_SAMPLE_RATE:
+        # Resample in memory rather than via a WAV file; both Whisper backends take host audio
+        audio = torchaudio.functional.resample(
+            torch.from_numpy(audio), sample_rate, WHISPER_SAMPLE_RATE
+        ).numpy()
+    return audio
 
 def transcribe_audio_optimized(audio_data, sample_rate):
     if audio_data is None:
         return None
     try:
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-            sf.write(temp_file.name, audio_data, sample_rate, format="wav")
-            temp_path = temp_file.name
-        result = whisper_pipe(temp_path)
+        if whisper_pipe is None:
+            segments, _ = whisper_model.transcribe(
+                prepare_whisper_audio(audio_data, sample_rate),
+                language="en",
+                vad_filter=True,
+                beam_size=1
+            )
+            text = "".join(segment.text for segment in segments).strip()
+            return text if text else None
+        
+        result = whisper_pipe({
+            "array": prepare_whisper_audio(audio_data, sample_rate),
+            "sampling_rate": WHISPER_SAMPLE_RATE
+        })
         text = result["text"].strip()
-        os.unlink(temp_path)
         return text if text else None
     except Exception as e:
         print(f"Error in transcription: {e}")
@@ -196,26 +521,48 @@ def generate_tts_audio_optimized(text):
         return None
     
     try:
-        cached_audio = tts_cache.get(get_cache_key(text))
-        if cached_audio and os.path.exists(cached_audio):
-            return cached_audio
+        key = get_cache_key(text)
+        with cache_lock:
+            cached_audio = tts_cache.get(key)
+        if cached_audio is not None:
+            return TTS_SAMPLE_RATE, cached_audio
         
         generator = kokoro_pipeline(text, voice='af_heart')
-        audio_path = f'/tmp/response_{hashlib.md5(text.encode()).hexdigest()}.wav'
-        for _, _, audio in generator:
-            sf.write(audio_path, audio, 24000)
+        audio = None
+        for _, _, chunk in generator:
+            audio = np.asarray(chunk, dtype=np.float32)
             break
+        if audio is None:
+            return None
         
         with cache_lock:
-            tts_cache[get_cache_key(text)] = audio_path
-        return audio_path
+            tts_cache[key] = audio
+        return TTS_SAMPLE_RATE, audio
     except Exception as e:
         print(f"Error in TTS generation: {e}")
         return None
 
+def compile_kokoro():
+    """Compile the Kokoro model; runs on tts_executor, the thread that later synthesizes"""
+    # Compilation is lazy, so a warm-up call surfaces any failure
+    eager_model = kokoro_pipeline.model
+    try:
+        kokoro_pipeline.model = torch.compile(eager_model, fullgraph=False)
+        for _ in kokoro_pipeline("Hello there.", voice='af_heart'):
+            pass
+        print("Kokoro model compiled!")
+    except Exception as e:
+        print(f"torch.compile failed for Kokoro, using eager mode: {e}")
+        kokoro_pipeline.model = eager_model
+
+def precompute_tts_phrases():
+    for phrase in TTS_PRECOMPUTED_PHRASES:
+        generate_tts_audio_optimized(phrase)
+
 def response_optimized(state: AppState, audio: tuple):
     if not audio:
-        return state, None
+        yield state, None
+        return
     
     audio_data, sample_rate = audio[1], audio[0]
     transcription = transcribe_audio_optimized(audio_data, sample_rate)
@@ -224,27 +571,57 @@ def response_optimized(state: AppState, audio: tuple):
         if transcription.startswith("Error"):
             transcription = "Error in audio transcription."
         
+        speaking = None
+        clips = queue.Queue()
+        
         state.conversation_history.append({"role": "user", "content": transcription})
+        print(f"User: {transcription}")
         
         if state.is_first_interaction:
-            assistant_message = "Welcome to EDU Bot, your UMass Dartmouth assistant—how can I help you today?"
+            assistant_message = WELCOME_MESSAGE
             state.is_first_interaction = False
         else:
-            # Retrieve relevant context using embeddings
-            context = retrieve_relevant_context(transcription, state.knowledge_base)
+            query_vector = get_query_vector(transcription)
             
-            # Generate response using Nemotron NIM with context
-            assistant_message = call_nemotron_nim(state.conversation_history, context)
+            # A near-identical earlier question skips retrieval and the LLM entirely
+            assistant_message = response_cache.get(query_vector) if query_vector is not None else None
+            if assistant_message is None:
+                context = retrieve_relevant_context(query_vector, state.kb_contents, state.kb_matrix,
+                                                    kb_index=kb_index, kb_matrix_i8=kb_matrix_i8)
+                
+                # Stream the response from Nemotron NIM in the background, synthesizing
+                # sentences while it decodes
+                completed = threading.Event()
+                speaking = turn_executor.submit(
+                    speak_token_stream, stream_nemotron_nim(state.conversation_history, context, completed), clips
+                )
         
-        state.conversation_history.append({"role": "assistant", "content": assistant_message})
+        if speaking is None:
+            clips.put(tts_executor.submit(generate_tts_audio_optimized, assistant_message))
+            clips.put(None)
         
-        print(f"User: {transcription}")
-        print(f"Assistant: {assistant_message}")
+        # Play each sentence as soon as it is synthesized (the streamed output appends chunks)
+        played = False
+        while (clip := clips.get()) is not None:
+            sentence_audio = clip.result()
+            if sentence_audio is not None:
+                played = True
+                yield state, sentence_audio
         
-        audio_path = generate_tts_audio_optimized(assistant_message)
-        return state, audio_path
+        if speaking is not None:
+            assistant_message = speaking.result()
+            # A reply cut off by a dropped stream must not be served to later questions
+            if query_vector is not None and completed.is_set():
+                response_cache.put(query_vector, assistant_message)
+        
+        # state is the session's own object, so this persists after the last yield
+        state.conversation_history.append({"role": "assistant", "content": assistant_message})
+        print(f"Assistant: {assistant_message}")
+        if not played:
+            yield state, None
+        return
     
-    return state, None
+    yield state, None
 
 def process_audio(audio: tuple, state: AppState):
     return audio, state
@@ -266,7 +643,7 @@ async function main() {
     const myvad = await vad.MicVAD.new({
       onSpeechStart: () => {
         var record = document.querySelector('.record-button');
-        var player = document.querySelector('#streaming-out')
+        var player = document.querySelector('#streaming-out audio')
         if (record != null && (player == null || player.paused)) {
           record.click();
         }
@@ -294,7 +671,16 @@ js_reset = """
 """
 
 # Initialize knowledge base at startup
-initial_knowledge_base = load_knowledge_base()
+initial_kb_contents, initial_kb_matrix = load_knowledge_base()
+# Shared by all sessions (FAISS indexes can't be deep-copied into gr.State)
+faiss_gpu_resources = None
+kb_index = build_kb_index(initial_kb_matrix)
+kb_matrix_i8 = build_kb_matrix_i8(initial_kb_matrix) if kb_index is None else None
+
+if KOKORO_AVAILABLE:
+    if KOKORO_TORCH_COMPILE and device == "cuda":
+        tts_executor.submit(compile_kokoro)
+    tts_executor.submit(precompute_tts_phrases)
 
 with gr.Blocks(js=js) as demo:
     gr.Markdown("## 🎓 EDU Bot - UMass Dartmouth (Powered by NVIDIA NIM + AWS)")
@@ -302,6 +688,8 @@ with gr.Blocks(js=js) as demo:
 
     output_audio = gr.Audio(
         label="Voice Response",
+        elem_id="streaming-out",
+        streaming=True,
         autoplay=True,
         show_label=True,
         container=True
@@ -316,7 +704,10 @@ with gr.Blocks(js=js) as demo:
         container=True
     )
 
-    state = gr.State(value=AppState(knowledge_base=initial_knowledge_base))
+    state = gr.State(value=AppState(
+        kb_contents=initial_kb_contents,
+        kb_matrix=initial_kb_matrix
+    ))
 
     stream = input_audio.start_recording(
         process_audio,